@@ -9,14 +9,30 @@ Usage:
 """
 
 import os
+import re
 import sys
-import json
+import orjson
+import io
 import base64
+import hashlib
+import asyncio
+import functools
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 import fitz  # pymupdf
 import pdfplumber
-from openai import OpenAI
+from typing import Literal
+from PIL import Image, ImageStat
+from openai import AsyncOpenAI, OpenAIError
+from pydantic import BaseModel, ValidationError
 from dotenv import load_dotenv
 
+try:
+    import tiktoken
+except ImportError:  # optional: token counts fall back to a chars/4 estimate
+    tiktoken = None
+
 # Load .env file
 load_dotenv()
 
@@ -27,22 +43,32 @@ load_dotenv()
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
 
 MODEL = "gpt-5-nano-2025-08-07"
-CHUNK_SIZE = 3000  # characters per chunk for LLM processing
+CHUNK_TOKENS = 750  # tokens per chunk for LLM processing (~3000 characters of prose)
+MAX_BATCH_TOKENS = 6000  # consecutive chunks are packed into one LLM call up to this many tokens
 MIN_IMAGE_SIZE = 100  # minimum width/height in pixels to consider an image meaningful
+MIN_IMAGE_BYTES = 4096  # smaller encoded images are flat fills/rules, not figures
+MAX_IMAGE_ASPECT = 8  # longer/shorter side ratio above which an image is a rule, divider or text strip
+MIN_IMAGE_VARIANCE = 50  # grey-level variance (256px thumbnail) below which an image is blank
+MAX_CONCURRENT_REQUESTS = 16  # in-flight OpenAI calls; tune to the account's rate limits
+OPENAI_MAX_RETRIES = 3  # SDK retries with exponential backoff on connection errors, 408/409/429 and 5xx
+OPENAI_TIMEOUT = 60.0  # seconds per request attempt
+PDF_WORKERS = min(os.cpu_count() or 1, 4)  # processes for local PDF parsing; gains flatten past ~4
+PDF_RANGE_PAGES = 16  # pages per worker task; bounds the parsed pages (and image bytes) held in memory
+LLM_CACHE_DIR = "data/.llm_cache"  # extraction results keyed by hash of model + prompt + input
+EXTRA_KEYS = ("title", "content", "description", "symbol", "value", "units", "context")  # optional node fields kept in the graph
+PROMPT_VERSION = "v2"  # bump to invalidate LLM_CACHE_DIR when prompts or response handling change
 
 # =============================================================================
-# EXTRACTION PROMPT
+# EXTRACTION PROMPTS
 # =============================================================================
 
-EXTRACT_ENTITIES_PROMPT = """Extract entities and relationships from this construction design code section.
-
-Document: {document_name}
-Page: {page_number}
+# Static instructions come first so every call shares the same prefix (for
+# OpenAI prompt caching); the per-call fields are appended with "".join.
 
-Text:
-\"\"\"
-{text}
-\"\"\"
+EXTRACT_ENTITIES_PROMPT = """Extract entities and relationships from a construction design code section.
+The document, page and section text are given at the end. The text may hold several
+excerpts, each starting with a <<<CHUNK n (page p)>>> marker - extract from all of them
+and set "page" on each entity to the page of the excerpt it came from.
 
 Entity types to extract:
 - Clause: numbered sections (e.g., "3.2.1", "4.1")
@@ -70,109 +96,205 @@ Relationship types:
 - CONTAINS: table/figure contains parameters
 - USES: formula uses parameter
 
-Return JSON only:
-{{
+Return JSON only (set "page" on every entity to the page given below, or for multi-excerpt
+input to the page in the excerpt's <<<CHUNK n (page p)>>> marker):
+{
   "entities": [
-    {{"type": "Table", "id": "table_a1", "name": "Table A.1", "title": "Density of materials", "page": {page_number}}},
-    {{"type": "Parameter", "id": "param_concrete_density", "name": "reinforced concrete density", "value": "25", "units": "kN/m³", "context": "for dead load calculations", "page": {page_number}}},
-    {{"type": "Parameter", "id": "param_gamma_g", "name": "γG", "symbol": "γG", "value": "1.35", "units": "", "context": "partial factor for permanent actions", "page": {page_number}}},
-    {{"type": "Clause", "id": "clause_4_1", "name": "4.1 General", "page": {page_number}}},
-    {{"type": "Figure", "id": "figure_5_2", "name": "Figure 5.2", "description": "Load distribution diagram", "page": {page_number}}}
+    {"type": "Table", "id": "table_a1", "name": "Table A.1", "title": "Density of materials", "page": 12},
+    {"type": "Parameter", "id": "param_concrete_density", "name": "reinforced concrete density", "value": "25", "units": "kN/m³", "context": "for dead load calculations", "page": 12},
+    {"type": "Parameter", "id": "param_gamma_g", "name": "γG", "symbol": "γG", "value": "1.35", "units": "", "context": "partial factor for permanent actions", "page": 12},
+    {"type": "Clause", "id": "clause_4_1", "name": "4.1 General", "page": 12},
+    {"type": "Figure", "id": "figure_5_2", "name": "Figure 5.2", "description": "Load distribution diagram", "page": 12}
   ],
   "relationships": [
-    {{"from_id": "table_a1", "type": "CONTAINS", "to_id": "param_concrete_density", "evidence": "Table A.1 row 1"}},
-    {{"from_id": "clause_4_1", "type": "REFERENCES", "to_id": "table_a1", "evidence": "see Table A.1"}}
+    {"from_id": "table_a1", "type": "CONTAINS", "to_id": "param_concrete_density", "evidence": "Table A.1 row 1"},
+    {"from_id": "clause_4_1", "type": "REFERENCES", "to_id": "table_a1", "evidence": "see Table A.1"}
   ]
-}}
+}
+
+Extract ALL values. Every number with meaning = a Parameter node. Return valid JSON only.
+
+"""
+
+# Vision prompt for figures/charts/graphs; document and page are appended per call
+EXTRACT_IMAGE_PROMPT = """Analyze this image from a construction design code document.
+The document and page are given at the end.
+
+CRITICAL: Extract EVERY fact, value, and piece of information as separate entities.
+Someone searching the knowledge graph must be able to find ANY information shown in this image.
+
+Extract as Parameter entities:
+- All numeric values (dimensions, coefficients, factors, loads, distances)
+- All labeled data points
+- All axis values and ranges from charts
+- All cell values from tables
+- All annotations and callouts
+- All formulas or expressions shown
+- All conditions or ranges (e.g., "for slopes 0° to 30°")
+
+Extract as Concept entities:
+- Technical terms shown
+- Categories or classifications depicted
+- Relationships illustrated (e.g., "load increases with height")
 
-Extract ALL values. Every number with meaning = a Parameter node. Return valid JSON only."""
+For the image itself:
+- Create ONE Figure/Chart/Table entity as the container
+- Link ALL extracted Parameters and Concepts to it with CONTAINS
+
+Return JSON (replace <page> with the page number given below):
+{
+  "entities": [
+    {"type": "Figure", "id": "fig_p<page>_1", "name": "Figure X.X", "description": "comprehensive description of what the figure shows", "page": 12},
+    {"type": "Parameter", "id": "param_1", "name": "snow load coefficient μ1", "symbol": "μ1", "value": "0.8", "units": "", "context": "for roof slope 30°", "page": 12},
+    {"type": "Parameter", "id": "param_2", "name": "roof slope range", "value": "0° to 60°", "context": "applicable range for coefficient", "page": 12},
+    {"type": "Concept", "id": "concept_1", "name": "drifted snow load", "description": "accumulation pattern on leeward side", "page": 12}
+  ],
+  "relationships": [
+    {"from_id": "fig_p<page>_1", "type": "CONTAINS", "to_id": "param_1", "evidence": "labeled in figure"},
+    {"from_id": "fig_p<page>_1", "type": "CONTAINS", "to_id": "param_2", "evidence": "axis range"},
+    {"from_id": "fig_p<page>_1", "type": "CONTAINS", "to_id": "concept_1", "evidence": "illustrated in diagram"}
+  ]
+}
+
+If the image is decorative (logo, border, no information), return empty entities array.
+Be exhaustive. Every fact = a node. Return valid JSON only.
+
+"""
+
+# Table prompt; document, page, index and markdown are appended per call
+EXTRACT_TABLE_PROMPT = """Extract entities from a table found in a construction design code.
+The document, page, table index and table content are given at the end.
+
+CRITICAL: Create a Parameter entity for EACH cell value that has meaning.
+Every numeric value, coefficient, factor, or named value = a separate Parameter node.
+
+Return JSON (replace <page> and <index> with the values given below):
+{
+  "entities": [
+    {"type": "Table", "id": "table_p<page>_<index>", "name": "Table X.X", "title": "infer from content", "page": 12},
+    {"type": "Parameter", "id": "param_1", "name": "descriptive name", "value": "the value", "units": "if any", "context": "row/column context", "page": 12},
+    ...more parameters for each meaningful cell...
+  ],
+  "relationships": [
+    {"from_id": "table_p<page>_<index>", "type": "CONTAINS", "to_id": "param_1", "evidence": "row X, column Y"}
+  ]
+}
+
+Return valid JSON only.
+
+"""
 
 
 # =============================================================================
-# FUNCTIONS
+# RESPONSE SCHEMA
 # =============================================================================
 
-def extract_text_from_pdf(pdf_path: str, start_page: int = 6, max_pages: int = None) -> list[dict]:
-    """Extract text from PDF, page by page."""
-    doc = fitz.open(pdf_path)
-    pages = []
+# Enforced server-side via OpenAI Structured Outputs (strict mode), so every
+# response has these keys and types. Optional fields come back as null; their
+# None defaults don't change the strict schema, but let cached results (stored
+# with nulls dropped) validate against the same models.
 
-    total_pages = len(doc)
-    start_idx = start_page - 1  # Convert to 0-indexed
+class Entity(BaseModel):
+    type: Literal["Clause", "Table", "Figure", "Chart", "Parameter", "Concept", "Formula"]
+    id: str
+    name: str
+    page: int
+    title: str | None = None
+    content: str | None = None
+    description: str | None = None
+    symbol: str | None = None
+    value: str | None = None
+    units: str | None = None
+    context: str | None = None
 
-    if max_pages:
-        end_idx = min(total_pages, start_idx + max_pages)
-    else:
-        end_idx = total_pages
 
-    for page_num in range(start_idx, end_idx):
-        page = doc[page_num]
-        text = page.get_text()
-        if text.strip():
-            pages.append({
-                "page": page_num + 1,
-                "text": text
-            })
+class Relationship(BaseModel):
+    from_id: str
+    type: Literal["REFERENCES", "DEFINED_IN", "EQUIVALENT_TO", "CONTAINS", "USES"]
+    to_id: str
+    evidence: str
 
-    doc.close()
-    return pages
 
+class Extraction(BaseModel):
+    entities: list[Entity]
+    relationships: list[Relationship]
 
-def extract_images_from_pdf(pdf_path: str, start_page: int = 6, max_pages: int = None) -> list[dict]:
-    """Extract meaningful images (figures, charts, graphs) from PDF.
 
-    Filters out small decorative images like logos, bullets, icons.
-    """
-    doc = fitz.open(pdf_path)
-    images = []
+# =============================================================================
+# FUNCTIONS
+# =============================================================================
 
-    total_pages = len(doc)
-    start_idx = start_page - 1  # Convert to 0-indexed
+def extract_tables_from_page(page, page_number: int) -> list[dict]:
+    """Extract tables from a pdfplumber page using its table detection."""
+    tables = []
 
-    if max_pages:
-        end_idx = min(total_pages, start_idx + max_pages)
-    else:
-        end_idx = total_pages
+    for table_idx, table_data in enumerate(page.extract_tables()):
+        if not table_data or len(table_data) < 2:  # Skip empty or single-row tables
+            continue
 
-    for page_num in range(start_idx, end_idx):
-        page = doc[page_num]
-        image_list = page.get_images()
+        # Convert to markdown for readability
+        headers = table_data[0] if table_data else []
+        rows = table_data[1:] if len(table_data) > 1 else []
 
-        for img_index, img in enumerate(image_list):
-            xref = img[0]
-            try:
-                base_image = doc.extract_image(xref)
-                width = base_image.get("width", 0)
-                height = base_image.get("height", 0)
+        # Clean up None values
+        headers = [str(h) if h else "" for h in headers]
+        rows = [[str(cell) if cell else "" for cell in row] for row in rows]
 
-                # Skip small images (decorative, logos, bullets)
-                if width < MIN_IMAGE_SIZE or height < MIN_IMAGE_SIZE:
-                    continue
+        lines = [" | ".join(headers), " | ".join(["---"] * len(headers))]
+        lines.extend(" | ".join(row) for row in rows)
+        markdown = "\n".join(lines)
 
-                image_bytes = base_image["image"]
-                image_b64 = base64.b64encode(image_bytes).decode("utf-8")
+        tables.append({
+            "page": page_number,
+            "index": table_idx,
+            "headers": headers,
+            "rows": rows,
+            "markdown": markdown.strip()
+        })
 
-                images.append({
-                    "page": page_num + 1,
-                    "index": img_index,
-                    "image_b64": image_b64,
-                    "ext": base_image.get("ext", "png"),
-                    "width": width,
-                    "height": height
-                })
-            except Exception:
-                continue
+    return tables
 
-    doc.close()
-    return images
 
+def looks_decorative(image_bytes: bytes, width: int, height: int) -> bool:
+    """Cheap local check for images the vision model would only flag as decorative.
 
-def extract_tables_from_pdf(pdf_path: str, start_page: int = 6, max_pages: int = None) -> list[dict]:
-    """Extract tables from PDF using pdfplumber's table detection."""
-    tables = []
+    Rejects very elongated images (rules, dividers, clipped text strips) and
+    near-uniform ones (blank or "intentionally blank" scanned pages). Variance
+    is measured on a small greyscale thumbnail, which JPEG decodes in draft mode.
+    """
+    if max(width, height) > MAX_IMAGE_ASPECT * min(width, height):
+        return True
+
+    try:
+        img = Image.open(io.BytesIO(image_bytes))
+        img.draft("L", (256, 256))
+        img = img.convert("L")
+        img.thumbnail((256, 256))
+    except Exception:
+        return False  # let the vision model decide on formats PIL can't read
+
+    return ImageStat.Stat(img).var[0] < MIN_IMAGE_VARIANCE
 
-    with pdfplumber.open(pdf_path) as pdf:
-        total_pages = len(pdf.pages)
+
+def iter_pages(pdf_path: str, start_page: int = 6, max_pages: int = None,
+               doc: fitz.Document | None = None):
+    """Yield text, tables and meaningful images (figures, charts, graphs) page by page.
+
+    The PDF is opened once with PyMuPDF (text, images) and once with pdfplumber
+    (tables), and both are walked in a single page loop. Images are kept as
+    raw bytes (base64 encoding happens at API-call time). Small decorative
+    images like logos, bullets and icons are filtered out, as are images
+    already yielded for an earlier page (repeated logos share an xref).
+
+    An already open PyMuPDF doc can be passed in to avoid parsing the file
+    again; it is left open for the caller.
+    """
+    owns_doc = doc is None
+    if owns_doc:
+        doc = fitz.open(pdf_path)
+    pdf = pdfplumber.open(pdf_path)
+    try:
+        total_pages = len(doc)
         start_idx = start_page - 1  # Convert to 0-indexed
 
         if max_pages:
@@ -180,251 +302,460 @@ def extract_tables_from_pdf(pdf_path: str, start_page: int = 6, max_pages: int =
         else:
             end_idx = total_pages
 
+        seen_xrefs = set()
+
         for page_num in range(start_idx, end_idx):
-            page = pdf.pages[page_num]
-            page_tables = page.extract_tables()
+            page = doc[page_num]
+            images = []
 
-            for table_idx, table_data in enumerate(page_tables):
-                if not table_data or len(table_data) < 2:  # Skip empty or single-row tables
+            for img_index, img in enumerate(page.get_images(full=False)):
+                xref = img[0]
+                if xref in seen_xrefs:
                     continue
+                seen_xrefs.add(xref)
 
-                # Convert to markdown for readability
-                headers = table_data[0] if table_data else []
-                rows = table_data[1:] if len(table_data) > 1 else []
+                # Skip small images (decorative, logos, bullets) using the
+                # dimensions from the image list, before extracting any bytes
+                width, height = img[2], img[3]
+                if width < MIN_IMAGE_SIZE or height < MIN_IMAGE_SIZE:
+                    continue
 
-                # Clean up None values
-                headers = [str(h) if h else "" for h in headers]
-                rows = [[str(cell) if cell else "" for cell in row] for row in rows]
+                try:
+                    base_image = doc.extract_image(xref)
+                    if len(base_image["image"]) < MIN_IMAGE_BYTES:
+                        continue
+                    if looks_decorative(base_image["image"], width, height):
+                        continue
+
+                    images.append({
+                        "page": page_num + 1,
+                        "index": img_index,
+                        "xref": xref,
+                        "image_bytes": base_image["image"],
+                        "ext": base_image.get("ext", "png"),
+                        "width": width,
+                        "height": height
+                    })
+                except Exception:
+                    continue
 
-                markdown = " | ".join(headers) + "\n"
-                markdown += " | ".join(["---"] * len(headers)) + "\n"
-                for row in rows:
-                    markdown += " | ".join(row) + "\n"
+            plumber_page = pdf.pages[page_num]
+            tables = extract_tables_from_page(plumber_page, page_num + 1)
+            plumber_page.close()  # drop pdfplumber's parsed layout cache for this page
 
-                tables.append({
-                    "page": page_num + 1,
-                    "index": table_idx,
-                    "headers": headers,
-                    "rows": rows,
-                    "markdown": markdown.strip()
-                })
+            yield {
+                "page": page_num + 1,
+                "text": page.get_text(),
+                "tables": tables,
+                "images": images
+            }
+    finally:
+        pdf.close()
+        if owns_doc:
+            doc.close()
+        fitz.TOOLS.store_shrink(100)  # release MuPDF's cached fonts/images for this document
 
-    return tables
 
+def _extract_page_range(args: tuple) -> list[dict]:
+    """Worker for extract_pages_parallel. Each process opens its own document."""
+    pdf_path, start_page, max_pages = args
+    return list(iter_pages(pdf_path, start_page, max_pages))
 
-def extract_entities_from_image(client: OpenAI, image_b64: str, ext: str, doc_name: str, page: int) -> dict:
-    """Use vision model to extract entities from an image (figure/chart/graph)."""
-    prompt = f"""Analyze this image from a construction design code document.
-Document: {doc_name}, Page: {page}
 
-CRITICAL: Extract EVERY fact, value, and piece of information as separate entities.
-Someone searching the knowledge graph must be able to find ANY information shown in this image.
+def extract_pages_parallel(pdf_path: str, start_page: int = 6, max_pages: int = None,
+                           workers: int = PDF_WORKERS):
+    """Run iter_pages across processes over contiguous ranges of up to PDF_RANGE_PAGES pages.
 
-Extract as Parameter entities:
-- All numeric values (dimensions, coefficients, factors, loads, distances)
-- All labeled data points
-- All axis values and ranges from charts
-- All cell values from tables
-- All annotations and callouts
-- All formulas or expressions shown
-- All conditions or ranges (e.g., "for slopes 0° to 30°")
+    Yields the pages in order, as each range completes. At most two ranges per
+    worker are submitted ahead of the one being yielded, so parsed pages waiting
+    in memory (image bytes included) are bounded by the window, not the
+    document. Images repeated across ranges are dropped so the output matches
+    a single iter_pages pass. With a single worker the pages are read
+    in-process, reusing the document opened here for the page count.
+    """
+    with fitz.open(pdf_path) as doc:
+        total_pages = len(doc)
 
-Extract as Concept entities:
-- Technical terms shown
-- Categories or classifications depicted
-- Relationships illustrated (e.g., "load increases with height")
+        start_idx = start_page - 1  # Convert to 0-indexed
+        end_idx = min(total_pages, start_idx + max_pages) if max_pages else total_pages
+        page_count = max(0, end_idx - start_idx)
+        if page_count == 0:
+            return
+
+        workers = max(1, min(workers, page_count))
+        if workers == 1:
+            yield from iter_pages(pdf_path, start_page, max_pages, doc=doc)
+            return
+
+    span = min(PDF_RANGE_PAGES, -(-page_count // workers))  # ceiling division
+    ranges = (
+        (pdf_path, start_page + offset, min(span, page_count - offset))
+        for offset in range(0, page_count, span)
+    )
 
-For the image itself:
-- Create ONE Figure/Chart/Table entity as the container
-- Link ALL extracted Parameters and Concepts to it with CONTAINS
+    seen_xrefs = set()
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque(pool.submit(_extract_page_range, args) for _, args in zip(range(2 * workers), ranges))
+        while pending:
+            range_pages = pending.popleft().result()
+            next_args = next(ranges, None)
+            if next_args is not None:
+                pending.append(pool.submit(_extract_page_range, next_args))
+            for page_data in range_pages:
+                unique = []
+                for img in page_data["images"]:
+                    if img["xref"] not in seen_xrefs:
+                        seen_xrefs.add(img["xref"])
+                        unique.append(img)
+                page_data["images"] = unique
+                yield page_data
+
+
+def print_entities(result: dict) -> None:
+    """Debug: print what was extracted, in a single write."""
+    lines = []
+    for e in result.get("entities", []):
+        etype = e.get('type', '?')
+        name = e.get('name', e.get('id', '?'))
+        val = e.get('value', '')
+        units = e.get('units', '')
+        lines.append(f"      → {etype}: {name}" + (f" = {val}{units}" if val else "") + "\n")
+    sys.stdout.write("".join(lines))
 
-Return JSON:
-{{
-  "entities": [
-    {{"type": "Figure", "id": "fig_p{page}_1", "name": "Figure X.X", "description": "comprehensive description of what the figure shows", "page": {page}}},
-    {{"type": "Parameter", "id": "param_1", "name": "snow load coefficient μ1", "symbol": "μ1", "value": "0.8", "units": "", "context": "for roof slope 30°", "page": {page}}},
-    {{"type": "Parameter", "id": "param_2", "name": "roof slope range", "value": "0° to 60°", "context": "applicable range for coefficient", "page": {page}}},
-    {{"type": "Concept", "id": "concept_1", "name": "drifted snow load", "description": "accumulation pattern on leeward side", "page": {page}}}
-  ],
-  "relationships": [
-    {{"from_id": "fig_p{page}_1", "type": "CONTAINS", "to_id": "param_1", "evidence": "labeled in figure"}},
-    {{"from_id": "fig_p{page}_1", "type": "CONTAINS", "to_id": "param_2", "evidence": "axis range"}},
-    {{"from_id": "fig_p{page}_1", "type": "CONTAINS", "to_id": "concept_1", "evidence": "illustrated in diagram"}}
-  ]
-}}
 
-If the image is decorative (logo, border, no information), return empty entities array.
-Be exhaustive. Every fact = a node. Return valid JSON only."""
+def cache_key(*parts: str) -> str:
+    """Hash the inputs that fully determine an LLM response.
+
+    MODEL and PROMPT_VERSION are always included. Each field is length-prefixed
+    so different splits of the same text cannot collide.
+    """
+    h = hashlib.sha256()
+    for part in (MODEL, PROMPT_VERSION, *parts):
+        data = part.encode("utf-8")
+        h.update(len(data).to_bytes(8, "big"))
+        h.update(data)
+    return h.hexdigest()
+
 
-    response = client.chat.completions.create(
+async def cached_call(key: str, call) -> dict:
+    """Return the cached result for key, or await call() and cache its result.
+
+    Results live as one JSON file per key in LLM_CACHE_DIR, so re-running
+    ingestion on an unchanged document makes no API calls. Failed calls raise
+    and are not cached.
+    """
+    path = os.path.join(LLM_CACHE_DIR, f"{key}.json")
+    if os.path.exists(path):
+        try:
+            with open(path, "rb") as f:
+                return Extraction.model_validate_json(f.read()).model_dump(exclude_none=True)
+        except ValidationError:
+            os.remove(path)  # corrupt or wrong shape: evict and re-fetch
+
+    result = await call()
+
+    os.makedirs(LLM_CACHE_DIR, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(orjson.dumps(result))
+    os.replace(tmp_path, path)  # atomic, so an interrupted run never leaves a partial entry
+
+    return result
+
+
+async def complete_extraction(client: AsyncOpenAI, content) -> dict:
+    """Ask the model for an Extraction and return it as a plain dict (nulls dropped)."""
+    response = await client.chat.completions.parse(
         model=MODEL,
-        messages=[{
-            "role": "user",
-            "content": [
-                {"type": "text", "text": prompt},
-                {"type": "image_url", "image_url": {"url": f"data:image/{ext};base64,{image_b64}"}}
-            ]
-        }],
+        messages=[{"role": "user", "content": content}],
         #temperature=0.1,
-        response_format={"type": "json_object"}
+        response_format=Extraction
     )
+    message = response.choices[0].message
+    if message.parsed is None:
+        raise ValueError(f"Model refused: {message.refusal}")
+    return message.parsed.model_dump(exclude_none=True)
 
-    content = response.choices[0].message.content
-    result = json.loads(content)
 
-    # Debug: print what was extracted
-    for e in result.get("entities", []):
-        etype = e.get('type', '?')
-        name = e.get('name', e.get('id', '?'))
-        val = e.get('value', '')
-        units = e.get('units', '')
-        print(f"      → {etype}: {name}" + (f" = {val}{units}" if val else ""))
+IMAGE_ID_PAGE = re.compile(r"^([a-z]+)_p\d+_")  # the fig_p<page>_1 ids EXTRACT_IMAGE_PROMPT asks for
 
+
+def set_image_page(result: dict, page: int) -> dict:
+    """Point an image extraction at page: every entity's page and any fig_p<n>_ style id."""
+    replacement = rf"\g<1>_p{page}_"
+    for entity in result.get("entities", []):
+        entity["page"] = page
+        entity["id"] = IMAGE_ID_PAGE.sub(replacement, entity["id"])
+    for rel in result.get("relationships", []):
+        rel["from_id"] = IMAGE_ID_PAGE.sub(replacement, rel["from_id"])
+        rel["to_id"] = IMAGE_ID_PAGE.sub(replacement, rel["to_id"])
     return result
 
 
-def extract_entities_from_table(client: OpenAI, table: dict, doc_name: str) -> dict:
-    """Use LLM to extract entities from a detected table."""
-    prompt = f"""Extract entities from this table found in a construction design code.
+async def extract_entities_from_image(client: AsyncOpenAI, image_bytes: bytes, ext: str, doc_name: str, page: int) -> dict:
+    """Use vision model to extract entities from an image (figure/chart/graph).
 
-Document: {doc_name}
-Page: {table['page']}
+    Results are cached by image content alone, not document or page, so a
+    figure repeated across pages or Eurocode parts is only sent once; a
+    cached result is re-pointed at this page with set_image_page.
+    """
+    prompt = "".join((EXTRACT_IMAGE_PROMPT, "Document: ", doc_name, "\nPage: ", str(page)))
 
-Table content (markdown):
-{table['markdown']}
+    async def call():
+        image_b64 = base64.b64encode(image_bytes).decode("ascii")
+        return await complete_extraction(client, [
+            {"type": "text", "text": prompt},
+            {"type": "image_url", "image_url": {"url": f"data:image/{ext};base64,{image_b64}"}}
+        ])
 
-CRITICAL: Create a Parameter entity for EACH cell value that has meaning.
-Every numeric value, coefficient, factor, or named value = a separate Parameter node.
+    image_hash = hashlib.sha256(image_bytes).hexdigest()
+    result = await cached_call(cache_key(EXTRACT_IMAGE_PROMPT, ext, image_hash), call)
+    result = set_image_page(result, page)
 
-Return JSON:
-{{
-  "entities": [
-    {{"type": "Table", "id": "table_p{table['page']}_{table['index']}", "name": "Table X.X", "title": "infer from content", "page": {table['page']}}},
-    {{"type": "Parameter", "id": "param_1", "name": "descriptive name", "value": "the value", "units": "if any", "context": "row/column context", "page": {table['page']}}},
-    ...more parameters for each meaningful cell...
-  ],
-  "relationships": [
-    {{"from_id": "table_p{table['page']}_{table['index']}", "type": "CONTAINS", "to_id": "param_1", "evidence": "row X, column Y"}}
-  ]
-}}
+    print_entities(result)
+
+    return result
 
-Return valid JSON only."""
 
-    response = client.chat.completions.create(
-        model=MODEL,
-        messages=[{"role": "user", "content": prompt}],
-        response_format={"type": "json_object"}
-    )
+async def extract_entities_from_table(client: AsyncOpenAI, table: dict, doc_name: str) -> dict:
+    """Use LLM to extract entities from a detected table."""
+    prompt = "".join((
+        EXTRACT_TABLE_PROMPT,
+        "Document: ", doc_name,
+        "\nPage: ", str(table["page"]),
+        "\nTable index: ", str(table["index"]),
+        "\n\nTable content (markdown):\n", table["markdown"]
+    ))
 
-    content = response.choices[0].message.content
-    result = json.loads(content)
+    async def call():
+        return await complete_extraction(client, prompt)
 
-    # Debug: print what was extracted
-    for e in result.get("entities", []):
-        etype = e.get('type', '?')
-        name = e.get('name', e.get('id', '?'))
-        val = e.get('value', '')
-        units = e.get('units', '')
-        print(f"      → {etype}: {name}" + (f" = {val}{units}" if val else ""))
+    result = await cached_call(cache_key(prompt), call)
+
+    print_entities(result)
 
     return result
 
 
-def chunk_text(text: str, chunk_size: int = CHUNK_SIZE) -> list[str]:
-    """Split text into chunks, trying to break at paragraph boundaries."""
-    if len(text) <= chunk_size:
+@functools.cache
+def token_encoding():
+    """Tokenizer for MODEL, or None if tiktoken or its encoding files are unavailable."""
+    if tiktoken is None:
+        print("tiktoken not installed, estimating tokens as characters / 4")
+        return None
+    try:
+        name = tiktoken.encoding_name_for_model(MODEL)
+    except KeyError:  # model newer than the installed tiktoken
+        name = "o200k_base"
+    try:
+        return tiktoken.get_encoding(name)
+    except Exception as e:  # encoding files are downloaded on first use
+        print(f"tiktoken encoding {name} unavailable ({e}), estimating tokens as characters / 4")
+        return None
+
+
+@functools.lru_cache(maxsize=4096)
+def count_tokens(text: str) -> int:
+    """Number of MODEL tokens in text."""
+    enc = token_encoding()
+    if enc is None:
+        return len(text) // 4
+    return len(enc.encode_ordinary(text))
+
+
+def chunk_text(text: str, max_tokens: int = CHUNK_TOKENS) -> list[str]:
+    """Split text into chunks of up to max_tokens, trying to break at paragraph boundaries."""
+    if count_tokens(text) <= max_tokens:
         return [text]
 
     chunks = []
-    current = ""
+    current = []  # paragraphs in the chunk being built
+    current_tokens = 0  # tokens in the chunk, counting one per "\n\n" separator
 
     paragraphs = text.split("\n\n")
     for para in paragraphs:
-        if len(current) + len(para) + 2 <= chunk_size:
-            current += para + "\n\n"
+        para_tokens = count_tokens(para) + 1
+        if current_tokens + para_tokens <= max_tokens:
+            current.append(para)
+            current_tokens += para_tokens
         else:
             if current:
-                chunks.append(current.strip())
-            current = para + "\n\n"
+                chunks.append("\n\n".join(current).strip())
+            current = [para]
+            current_tokens = para_tokens
+
+    tail = "\n\n".join(current).strip()
+    if tail:
+        chunks.append(tail)
 
-    if current.strip():
-        chunks.append(current.strip())
+    return chunks if chunks else [text]
 
-    return chunks if chunks else [text[:chunk_size]]
 
+def batch_chunks(chunks: list[tuple[int, str]], max_tokens: int = MAX_BATCH_TOKENS) -> list[tuple[str, str]]:
+    """Pack consecutive (page, chunk) pairs into LLM inputs of up to max_tokens, saving round trips.
 
-def extract_entities_from_chunk(client: OpenAI, text: str, doc_name: str, page: int) -> dict:
+    Returns (pages, text) pairs, where pages is "12" or a range like "12-14".
+    A batch of several chunks marks each one with a <<<CHUNK n (page p)>>>
+    delimiter so entities can still be attributed to their page.
+    """
+    groups = []
+    current = []
+    current_tokens = 0
+
+    for page, chunk in chunks:
+        chunk_tokens = count_tokens(chunk)
+        if current and current_tokens + chunk_tokens > max_tokens:
+            groups.append(current)
+            current = []
+            current_tokens = 0
+        current.append((page, chunk))
+        current_tokens += chunk_tokens
+
+    if current:
+        groups.append(current)
+
+    batches = []
+    for group in groups:
+        first, last = group[0][0], group[-1][0]
+        pages = str(first) if first == last else f"{first}-{last}"
+        if len(group) == 1:
+            text = group[0][1]
+        else:
+            text = "\n\n".join(
+                f"<<<CHUNK {n} (page {page})>>>\n{chunk}" for n, (page, chunk) in enumerate(group, 1)
+            )
+        batches.append((pages, text))
+
+    return batches
+
+
+async def extract_entities_from_chunk(client: AsyncOpenAI, text: str, doc_name: str, page: int | str) -> dict:
     """Use LLM to extract entities from a text chunk."""
-    prompt = EXTRACT_ENTITIES_PROMPT.format(
-        document_name=doc_name,
-        page_number=page,
-        text=text
-    )
+    prompt = "".join((
+        EXTRACT_ENTITIES_PROMPT,
+        "Document: ", doc_name,
+        "\nPage: ", str(page),
+        '\n\nText:\n"""\n', text, '\n"""\n'
+    ))
 
-    response = client.chat.completions.create(
-        model=MODEL,
-        messages=[{"role": "user", "content": prompt}],
-        #temperature=0.1,
-        response_format={"type": "json_object"}
-    )
+    async def call():
+        return await complete_extraction(client, prompt)
 
-    content = response.choices[0].message.content
-    result = json.loads(content)
+    result = await cached_call(cache_key(prompt), call)
 
-    # Debug: print what was extracted
-    for e in result.get("entities", []):
-        etype = e.get('type', '?')
-        name = e.get('name', e.get('id', '?'))
-        val = e.get('value', '')
-        units = e.get('units', '')
-        print(f"      → {etype}: {name}" + (f" = {val}{units}" if val else ""))
+    print_entities(result)
 
     return result
 
 
-def build_graph(extractions: list[dict], doc_id: str) -> dict:
-    """Build a graph structure from all extractions."""
-    nodes = {}
-    edges = []
-
-    for extraction in extractions:
-        # Add entities as nodes
-        for entity in extraction.get("entities", []):
-            node_id = f"{doc_id}_{entity['id']}"
-            node_data = {
-                "id": node_id,
-                "type": entity.get("type"),
-                "name": entity.get("name"),
-                "page": entity.get("page"),
-                "document": doc_id
-            }
-            # Include all extra fields (content, value, units, description, context, etc.)
-            for key in ["title", "content", "description", "symbol", "value", "units", "context"]:
-                if key in entity and entity[key]:
-                    node_data[key] = entity[key]
-
-            nodes[node_id] = node_data
-
-        # Add relationships as edges
-        for rel in extraction.get("relationships", []):
-            edges.append({
-                "source": f"{doc_id}_{rel['from_id']}",
-                "target": f"{doc_id}_{rel['to_id']}",
-                "type": rel["type"],
-                "evidence": rel.get("evidence", "")
-            })
-
-    # NetworkX-compatible format
-    return {
-        "directed": True,
-        "multigraph": False,
-        "graph": {"document": doc_id},
-        "nodes": [{"id": nid, **data} for nid, data in nodes.items()],
-        "links": edges
-    }
-
-
-def ingest_document(pdf_path: str, output_path: str = None, start_page: int = 6, max_pages: int = None) -> dict:
+def extraction_to_records(extraction: dict, doc_id: str) -> tuple[list[dict], list[dict]]:
+    """Turn one extraction into graph nodes and edges (ids prefixed with doc_id)."""
+    nodes = []
+    for entity in extraction.get("entities", []):
+        get = entity.get
+        node_data = {
+            "id": f"{doc_id}_{entity['id']}",
+            "type": get("type"),
+            "name": get("name"),
+            "page": get("page"),
+            "document": doc_id
+        }
+        # Include all extra fields (content, value, units, description, context, etc.)
+        node_data.update({key: value for key in EXTRA_KEYS if (value := get(key))})
+        nodes.append(node_data)
+
+    edges = [{
+        "source": f"{doc_id}_{rel['from_id']}",
+        "target": f"{doc_id}_{rel['to_id']}",
+        "type": rel["type"],
+        "evidence": rel.get("evidence", "")
+    } for rel in extraction.get("relationships", [])]
+
+    return nodes, edges
+
+
+def append_records(job: int, extraction: dict, doc_id: str, nodes_file, edges_file) -> None:
+    """Append an extraction's nodes and edges to the sidecar files as [job, record] JSON lines."""
+    nodes, edges = extraction_to_records(extraction, doc_id)
+    nodes_file.write(b"".join(orjson.dumps([job, node]) + b"\n" for node in nodes))
+    edges_file.write(b"".join(orjson.dumps([job, edge]) + b"\n" for edge in edges))
+
+
+def split_record(line: bytes) -> tuple[int, bytes]:
+    """Split a sidecar line b'[job,{...}]' into the job index and the record's JSON."""
+    sep = line.index(b",")
+    return int(line[1:sep]), line[sep + 1:line.rindex(b"]")]
+
+
+def write_graph(doc_id: str, nodes_path: str, edges_path: str, output_path: str,
+                pretty: bool = False) -> tuple[int, int]:
+    """Merge the JSONL sidecars into the final NetworkX-format graph JSON.
+
+    Sidecar lines arrive in response order, so records are put back in job
+    order here and the output does not depend on network timing. A node id
+    seen more than once keeps the position of its first occurrence and the
+    data of its last. Nodes are kept as their encoded JSON, which takes far
+    less memory than dicts and is written out as-is. Edges are only indexed
+    by (job, file offset) and read back from disk in order, so the full edge
+    list is never held in memory. pretty=True indents the output for reading
+    by hand, which needs everything decoded. Returns (node_count, edge_count).
+    """
+    nodes = {}  # id -> [first (job, line), last (job, line), encoded node]
+    with open(nodes_path, "rb") as f:
+        for line_no, line in enumerate(f):
+            job, node = split_record(line)
+            key = (job, line_no)
+            node_id = orjson.loads(node)["id"]
+            entry = nodes.get(node_id)
+            if entry is None:
+                nodes[node_id] = [key, key, node]
+            elif key < entry[0]:
+                entry[0] = key
+            elif key > entry[1]:
+                entry[1] = key
+                entry[2] = node
+    ordered_nodes = [entry[2] for entry in sorted(nodes.values(), key=lambda entry: entry[0])]
+
+    edge_index = []  # (job, offset) per edge line
+    with open(edges_path, "rb") as f:
+        offset = 0
+        for line in f:
+            edge_index.append((int(line[1:line.index(b",")]), offset))
+            offset += len(line)
+    edge_index.sort()
+
+    def ordered_edges(f):
+        for _, offset in edge_index:
+            f.seek(offset)
+            yield split_record(f.readline())[1]
+
+    header = {"directed": True, "multigraph": False, "graph": {"document": doc_id}}
+
+    if pretty:
+        with open(edges_path, "rb") as f:
+            links = [orjson.loads(edge) for edge in ordered_edges(f)]
+        graph = {**header, "nodes": [orjson.loads(node) for node in ordered_nodes], "links": links}
+        with open(output_path, "wb") as f:
+            f.write(orjson.dumps(graph, option=orjson.OPT_INDENT_2))
+        return len(ordered_nodes), len(links)
+
+    with open(output_path, "wb") as out, open(edges_path, "rb") as f:
+        out.write(orjson.dumps(header)[:-1] + b',"nodes":[')
+        out.write(b",".join(ordered_nodes))
+        out.write(b'],"links":[')
+        for n, edge in enumerate(ordered_edges(f)):
+            if n:
+                out.write(b",")
+            out.write(edge)
+        out.write(b"]}")
+
+    return len(ordered_nodes), len(edge_index)
+
+
+async def ingest_document(pdf_path: str, output_path: str = None, start_page: int = 6, max_pages: int = None,
+                          concurrency: int = MAX_CONCURRENT_REQUESTS, workers: int = PDF_WORKERS,
+                          pretty: bool = False) -> dict:
     """Main ingestion function.
 
     Args:
@@ -432,9 +763,17 @@ def ingest_document(pdf_path: str, output_path: str = None, start_page: int = 6,
         output_path: Where to save the graph JSON (default: data/graph_<docid>.json)
         start_page: Page to start from (default: 6, to skip front matter)
         max_pages: Maximum pages to process (default: None = all pages)
+        concurrency: Maximum OpenAI requests in flight (default: MAX_CONCURRENT_REQUESTS)
+        workers: Processes for local PDF parsing (default: PDF_WORKERS)
+        pretty: Indent the output JSON (default: False = compact)
+
+    Returns a summary: {"output_path": ..., "nodes": <count>, "edges": <count>,
+    "failed": <extraction calls that errored>}.
     """
     if not os.path.exists(pdf_path):
         raise FileNotFoundError(f"PDF not found: {pdf_path}")
+    if concurrency < 1:
+        raise ValueError(f"concurrency must be at least 1, got {concurrency}")
 
     doc_name = os.path.basename(pdf_path)
     doc_id = os.path.splitext(doc_name)[0].replace(".", "_")
@@ -450,101 +789,158 @@ def ingest_document(pdf_path: str, output_path: str = None, start_page: int = 6,
     else:
         print(f"Processing {doc_name} (from page {start_page})...")
 
-    # Extract text
-    print("Extracting text...")
-    pages = extract_text_from_pdf(pdf_path, start_page, max_pages)
-    print(f"  Found {len(pages)} pages with text")
-
-    # Extract tables (using pdfplumber's detection)
-    print("Extracting tables...")
-    tables = extract_tables_from_pdf(pdf_path, start_page, max_pages)
-    print(f"  Found {len(tables)} tables")
-
-    # Extract images (figures, charts, graphs) - filtered by size
-    print("Extracting images...")
-    images = extract_images_from_pdf(pdf_path, start_page, max_pages)
-    print(f"  Found {len(images)} meaningful images (filtered small/decorative)")
-
-    # Initialize OpenAI client
-    client = OpenAI(api_key=OPENAI_API_KEY)
-
-    extractions = []
-
-    # Process text chunks
-    total_chunks = sum(len(chunk_text(p["text"])) for p in pages)
-    processed = 0
-
-    print(f"Extracting entities from text ({total_chunks} chunks)...")
-
-    for page_data in pages:
-        chunks = chunk_text(page_data["text"])
-
-        for chunk in chunks:
-            if len(chunk.strip()) < 50:  # Skip very short chunks
-                processed += 1
-                continue
+    nodes_path = f"{output_path}.nodes.jsonl"
+    edges_path = f"{output_path}.edges.jsonl"
+
+    # Extract text, tables (pdfplumber's detection) and images (figures, charts,
+    # graphs) - images filtered by size
+    print("Extracting text, tables and images...")
+    # Spill image bytes to disk as pages arrive; each is read back only while
+    # its API call is in flight. The directory is removed on every exit path.
+    with tempfile.TemporaryDirectory(prefix="ingest_images_") as image_dir:
+        pages = []
+        tables = []
+        images = []
+        # Identical content (repeated figures, boilerplate tables) is only sent to the LLM once
+        seen_hashes = set()
+        duplicates = 0
+        for page_data in extract_pages_parallel(pdf_path, start_page, max_pages, workers):
+            if page_data["text"].strip():
+                pages.append(page_data)
+            for table in page_data.pop("tables"):
+                table_hash = hashlib.sha256(" ".join(table["markdown"].split()).encode("utf-8")).digest()
+                if table_hash in seen_hashes:
+                    duplicates += 1
+                    continue
+                seen_hashes.add(table_hash)
+                tables.append(table)
+            for img in page_data.pop("images"):
+                image_bytes = img.pop("image_bytes")
+                image_hash = hashlib.sha256(image_bytes).digest()
+                if image_hash in seen_hashes:
+                    duplicates += 1
+                    continue
+                seen_hashes.add(image_hash)
+                img["path"] = os.path.join(image_dir, f"p{img['page']}_{img['index']}.{img['ext']}")
+                with open(img["path"], "wb") as f:
+                    f.write(image_bytes)
+                images.append(img)
+        print(f"  Found {len(pages)} pages with text")
+        print(f"  Found {len(tables)} tables")
+        print(f"  Found {len(images)} meaningful images (filtered small/decorative/repeated)")
+        if duplicates:
+            print(f"  Skipped {duplicates} duplicate tables/images")
+
+        # Initialize OpenAI client; one client is shared so its connections are reused
+        client = AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=OPENAI_MAX_RETRIES, timeout=OPENAI_TIMEOUT)
+        sem = asyncio.Semaphore(concurrency)
+
+        # Process text chunks, packed into as few calls as possible
+        chunk_jobs = batch_chunks([
+            (page_data["page"], chunk)
+            for page_data in pages
+            for chunk in chunk_text(page_data["text"])
+            if len(chunk.strip()) >= 50  # Skip very short chunks
+        ])
+        processed = 0
+        # Calls that still fail after the SDK's retries (or are refused / fail
+        # validation) are reported at the end; anything else is a bug and raises
+        failed = 0
+
+        async def process_chunk(job: int, page: str, chunk: str) -> None:
+            nonlocal processed, failed
+            async with sem:
+                try:
+                    extraction = await extract_entities_from_chunk(client, chunk, doc_name, page)
+                except (OpenAIError, ValueError) as e:
+                    processed += 1
+                    failed += 1
+                    print(f"  [{processed}/{len(chunk_jobs)}] Page {page}: Error - {e}")
+                    return
+
+            entity_count = len(extraction.get("entities", []))
+            rel_count = len(extraction.get("relationships", []))
+            processed += 1
+            print(f"  [{processed}/{len(chunk_jobs)}] Page {page}: {entity_count} entities, {rel_count} relationships")
+            record(job, extraction)
+
+        # Process tables (detected by pdfplumber)
+        async def process_table(i: int, table: dict) -> None:
+            nonlocal failed
+            async with sem:
+                try:
+                    extraction = await extract_entities_from_table(client, table, doc_name)
+                except (OpenAIError, ValueError) as e:
+                    failed += 1
+                    print(f"  [{i+1}/{len(tables)}] Page {table['page']}: Error - {e}")
+                    return
+
+            if not extraction.get("entities"):
+                return
+            entity_count = len(extraction.get("entities", []))
+            print(f"  [{i+1}/{len(tables)}] Page {table['page']}: {entity_count} entities from table")
+            record(len(chunk_jobs) + i, extraction)
+
+        # Process images
+        async def process_image(i: int, img_data: dict) -> None:
+            nonlocal failed
+            async with sem:
+                with open(img_data["path"], "rb") as f:
+                    image_bytes = f.read()
+                try:
+                    extraction = await extract_entities_from_image(
+                        client,
+                        image_bytes,
+                        img_data["ext"],
+                        doc_name,
+                        img_data["page"]
+                    )
+                except (OpenAIError, ValueError) as e:
+                    failed += 1
+                    print(f"  [{i+1}/{len(images)}] Page {img_data['page']}: Error - {e}")
+                    return
+
+            if not extraction.get("entities"):
+                print(f"  [{i+1}/{len(images)}] Page {img_data['page']}: skipped (not meaningful)")
+                return
+            entity_count = len(extraction.get("entities", []))
+            print(f"  [{i+1}/{len(images)}] Page {img_data['page']}: {entity_count} entities from image")
+            record(len(chunk_jobs) + len(tables) + i, extraction)
+
+        print(f"Extracting entities ({len(chunk_jobs)} text batches, {len(tables)} tables, "
+              f"{len(images)} images, up to {concurrency} requests in flight)...")
+
+        # Nodes and edges are streamed to JSONL sidecars as extractions arrive, so
+        # raw extractions are not held in memory and partial results survive a crash.
+        # Each line is tagged with its job's index (chunks, then tables, then
+        # images) so write_graph can restore job order.
+        with open(nodes_path, "wb") as nodes_file, open(edges_path, "wb") as edges_file:
+            def record(job: int, extraction: dict) -> None:
+                append_records(job, extraction, doc_id, nodes_file, edges_file)
 
             try:
-                extraction = extract_entities_from_chunk(
-                    client, chunk, doc_name, page_data["page"]
+                await asyncio.gather(
+                    *(process_chunk(job, page, chunk) for job, (page, chunk) in enumerate(chunk_jobs)),
+                    *(process_table(i, table) for i, table in enumerate(tables)),
+                    *(process_image(i, img_data) for i, img_data in enumerate(images)),
                 )
-                extractions.append(extraction)
-
-                entity_count = len(extraction.get("entities", []))
-                rel_count = len(extraction.get("relationships", []))
-                processed += 1
-                print(f"  [{processed}/{total_chunks}] Page {page_data['page']}: {entity_count} entities, {rel_count} relationships")
+            finally:
+                await client.close()
 
-            except Exception as e:
-                processed += 1
-                print(f"  [{processed}/{total_chunks}] Page {page_data['page']}: Error - {e}")
-
-    # Process tables (detected by pdfplumber)
-    if tables:
-        print(f"Extracting entities from tables ({len(tables)} tables)...")
-        for i, table in enumerate(tables):
-            try:
-                extraction = extract_entities_from_table(client, table, doc_name)
-                if extraction.get("entities"):
-                    extractions.append(extraction)
-                    entity_count = len(extraction.get("entities", []))
-                    print(f"  [{i+1}/{len(tables)}] Page {table['page']}: {entity_count} entities from table")
-            except Exception as e:
-                print(f"  [{i+1}/{len(tables)}] Page {table['page']}: Error - {e}")
-
-    # Process images
-    if images:
-        print(f"Extracting entities from images ({len(images)} images)...")
-        for i, img_data in enumerate(images):
-            try:
-                extraction = extract_entities_from_image(
-                    client,
-                    img_data["image_b64"],
-                    img_data["ext"],
-                    doc_name,
-                    img_data["page"]
-                )
-                if extraction.get("entities"):
-                    extractions.append(extraction)
-                    entity_count = len(extraction.get("entities", []))
-                    print(f"  [{i+1}/{len(images)}] Page {img_data['page']}: {entity_count} entities from image")
-                else:
-                    print(f"  [{i+1}/{len(images)}] Page {img_data['page']}: skipped (not meaningful)")
-            except Exception as e:
-                print(f"  [{i+1}/{len(images)}] Page {img_data['page']}: Error - {e}")
-
-    print("Building graph...")
-    graph = build_graph(extractions, doc_id)
-
-    print(f"Saving to {output_path}...")
-    with open(output_path, "w") as f:
-        json.dump(graph, f, indent=2)
+    print(f"Building graph and saving to {output_path}...")
+    node_count, edge_count = await asyncio.to_thread(
+        write_graph, doc_id, nodes_path, edges_path, output_path, pretty
+    )
+    os.remove(nodes_path)
+    os.remove(edges_path)
 
     print(f"\nDone!")
-    print(f"  Nodes: {len(graph['nodes'])}")
-    print(f"  Edges: {len(graph['links'])}")
+    print(f"  Nodes: {node_count}")
+    print(f"  Edges: {edge_count}")
+    if failed:
+        print(f"  Failed: {failed} extractions (rerun to retry them; completed calls are cached)")
 
-    return graph
+    return {"output_path": output_path, "nodes": node_count, "edges": edge_count, "failed": failed}
 
 
 # =============================================================================
@@ -561,7 +957,16 @@ if __name__ == "__main__":
                         help="Page to start from (default: 6, to skip front matter)")
     parser.add_argument("--max-pages", type=int, default=None,
                         help="Max pages to process (default: all)")
+    parser.add_argument("--concurrency", type=int, default=MAX_CONCURRENT_REQUESTS,
+                        help=f"Max OpenAI requests in flight (default: {MAX_CONCURRENT_REQUESTS})")
+    parser.add_argument("--workers", type=int, default=PDF_WORKERS,
+                        help=f"Processes for local PDF parsing (default: {PDF_WORKERS})")
+    parser.add_argument("--pretty", action="store_true",
+                        help="Indent the output JSON (default: compact)")
 
     args = parser.parse_args()
+    if args.concurrency < 1:
+        parser.error("--concurrency must be at least 1")
 
-    ingest_document(args.pdf_path, args.output, args.start_page, args.max_pages)
+    asyncio.run(ingest_document(args.pdf_path, args.output, args.start_page, args.max_pages,
+                                args.concurrency, args.workers, args.pretty))